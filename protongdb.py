@@ -6,18 +6,49 @@
 # Hence this script is licensed under GPLv3.
 
 import argparse
+import email.utils
+import gc
+import http.client
 import logging
 import os
+import pickle
+import shlex
+import shutil
 import sys
-import string
+import tempfile
 import subprocess
 import time
+import urllib.error
 import urllib.request
-from protontricks import *
 from pathlib import Path
 
 logger = logging.getLogger("protongdb")
 
+CACHE_DIR = Path.home() / ".cache" / "protongdb"
+# Bump whenever the format of the cached launch configurations changes.
+LAUNCH_CONFIG_CACHE_VERSION = 2
+
+WINERELOAD_URL = "https://gist.githubusercontent.com/rbernon/cdbdc1b0e892f91e7449fcf3dda80bb7/raw/d8cf549bf751d99ed0fe515e36f99ff5c01b7287/WineReload.py"
+WINE_DLL_OVERRIDES = "steam.exe=b;dotnetfx35.exe=b;dxvk_config=n;d3d11=n;d3d10=n;d3d10core=n;d3d10_1=n;d3d9=n;dxgi=n"
+
+# Paths relative to the Proton install dir, 64-bit first.
+PROTON_LIB_DIRS = ("files/lib64/", "files/lib/")
+PROTON_WINE_DLL_DIRS = ("files/lib64/wine", "files/lib/wine")
+PROTON_GST_PLUGIN_DIRS = ("files/lib64/gstreamer-1.0", "files/lib/gstreamer-1.0")
+
+GDB_SCRIPT = "".join(f"{command}\n" for command in [
+    "set confirm off",
+    "set pagination off",
+    "handle SIGUSR1 noprint nostop",
+    "handle SIGSYS noprint nostop",
+    "source /tmp/winereload.py",
+])
+
+# Re-check for a newer winereload.py at most once a week.
+WINERELOAD_TTL = 7 * 24 * 60 * 60
+# Give up on the download and use the cached copy after this many seconds.
+WINERELOAD_TIMEOUT = 10
+
 def enable_logging(info=False):
     level = logging.INFO if info else logging.WARNING
     logging.basicConfig(
@@ -29,20 +60,45 @@ def normalize_path(path):
         return ""
     return path.replace('\\', '/')
 
-def get_launch_executable(appid, appinfo)   :
-    app_infos = []
+def split_arguments(arguments):
+    if not arguments:
+        return ()
+    # Keep quoted arguments together, but leave backslashes alone since
+    # they're path separators in Windows arguments, and don't treat '#'
+    # as the start of a comment.
+    lex = shlex.shlex(arguments, posix=True)
+    lex.whitespace_split = True
+    lex.escape = ""
+    lex.commenters = ""
+    try:
+        return tuple(lex)
+    except ValueError:
+        # Unbalanced quotes, fall back to splitting on whitespace.
+        return tuple(arguments.split())
+
+def get_launch_configs(appinfo):
+    # Boil appinfo down to the Windows launch configurations of each app,
+    # which is all we need from it.
+    launch_configs = {}
     for app in appinfo:
-        if app["appinfo"]["appid"] == appid:
-            launch_infos = app["appinfo"]["config"]["launch"]
-            for launch_info in launch_infos.values():
-                if not ("config" in launch_info and "oslist" in launch_info["config"]) or ("windows" in launch_info["config"]["oslist"]):
-                    beta_key = None
-                    if "config" in launch_info:
-                        beta_key = launch_info["config"].get("betakey")
-                    arguments = launch_info.get("arguments")
-                    arguments = arguments.split() if arguments else []
-                    app_infos.append((launch_info.get("description"), normalize_path(launch_info.get("workingdir")), normalize_path(launch_info["executable"]), beta_key, arguments))
-    return app_infos
+        app_infos = []
+        launch_infos = app["appinfo"].get("config", {}).get("launch", {})
+        for launch_info in launch_infos.values():
+            executable = launch_info.get("executable")
+            if not executable:
+                continue
+            config = launch_info.get("config") or {}
+            oslist = config.get("oslist")
+            if oslist and "windows" not in oslist:
+                continue
+            arguments = split_arguments(launch_info.get("arguments"))
+            app_infos.append((launch_info.get("description"), normalize_path(launch_info.get("workingdir")), normalize_path(executable), config.get("betakey"), arguments))
+        if app_infos:
+            launch_configs[app["appinfo"]["appid"]] = app_infos
+    return launch_configs
+
+def get_launch_executable(appid, launch_configs):
+    return launch_configs.get(appid, [])
 
 def prepend_args(x, y, delim):
     return (y + delim + x) if y else x
@@ -50,12 +106,145 @@ def prepend_args(x, y, delim):
 def append_args(x, y, delim):
     return (x + delim + y) if y else x
 
+def join_paths(root, paths, delim=":"):
+    return delim.join(f"{root}/{path}" for path in paths)
+
+def get_env_spec(appid, steam_path, proton_app, game_app):
+    # (name, how to combine with any existing value, value, delimiter)
+    proton_path = proton_app.install_path
+    return [
+        ("PATH", "append", f"{proton_path}/files/bin", ":"),
+        ("WINEDEBUG", "default", "-all", None),
+        ("WINEDLLPATH", "prepend", join_paths(proton_path, PROTON_WINE_DLL_DIRS), ":"),
+        ("LD_LIBRARY_PATH", "default", f"{join_paths(proton_path, PROTON_LIB_DIRS)}:{game_app.install_path}", None),
+        ("WINEPREFIX", "default", str(game_app.prefix_path), None),
+        ("WINEESYNC", "default", "1", None),
+        ("WINEFSYNC", "default", "1", None),
+        ("SteamGameId", "default", str(appid), None),
+        ("SteamAppId", "default", str(appid), None),
+        ("WINEDLLOVERRIDES", "append", WINE_DLL_OVERRIDES, ";"),
+        ("STEAM_COMPAT_CLIENT_INSTALL_PATH", "default", str(steam_path), None),
+        ("WINE_LARGE_ADDRESS_AWARE", "default", "1", None),
+        ("GST_PLUGIN_SYSTEM_PATH_1_0", "prepend", join_paths(proton_path, PROTON_GST_PLUGIN_DIRS), ":"),
+        ("WINE_GST_REGISTRY_DIR", "default", f"{game_app.prefix_path}/gstreamer-1.0/", None),
+    ]
+
+def apply_env_spec(environ, env_spec):
+    # Merge the defaults in one go, letting the existing environment win,
+    # then combine the path-like variables with whatever is already set.
+    defaults = {name: value for name, mode, value, _ in env_spec if mode == "default"}
+    env_vars = {**defaults, **environ}
+    for name, mode, value, delim in env_spec:
+        if mode == "append":
+            env_vars[name] = append_args(value, environ.get(name), delim)
+        elif mode == "prepend":
+            env_vars[name] = prepend_args(value, environ.get(name), delim)
+    return env_vars
+
 def list_to_space_str(lst):
     return ' '.join(lst)
 
 def list_to_space_str_prefix(lst, prefix):
     return " " + list_to_space_str(lst) if lst else ""
 
+def write_cache_file(path, write):
+    # Write to a temp file of our own and move it into place, so that
+    # concurrent runs never see or publish a half-written cache file.
+    path.parent.mkdir(parents=True, exist_ok=True)
+    f = tempfile.NamedTemporaryFile(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False)
+    try:
+        with f:
+            write(f)
+        os.replace(f.name, path)
+    except BaseException:
+        try:
+            os.unlink(f.name)
+        except OSError:
+            pass
+        raise
+
+def get_cached_launch_configs(appinfo_path):
+    # Parsing appinfo.vdf is slow, so keep the launch configurations
+    # around and only re-parse when the file's mtime or size changes.
+    cache_path = CACHE_DIR / "launch_configs.pkl"
+    try:
+        st = appinfo_path.stat()
+    except OSError:
+        return None
+    key = (LAUNCH_CONFIG_CACHE_VERSION, st.st_mtime_ns, st.st_size)
+
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, launch_configs = pickle.load(f)
+        if cached_key == key:
+            return launch_configs
+    except Exception:
+        pass
+
+    from protontricks.steam import get_appinfo_sections
+
+    appinfo = get_appinfo_sections(appinfo_path)
+    if not appinfo:
+        return None
+    launch_configs = get_launch_configs(appinfo)
+    del appinfo
+
+    try:
+        write_cache_file(cache_path, lambda f: pickle.dump((key, launch_configs), f, protocol=pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        logger.info(f"Couldn't write launch configuration cache: {e}")
+
+    return launch_configs
+
+def fetch_winereload(dest):
+    cache_path = CACHE_DIR / "winereload.py"
+    try:
+        st = cache_path.stat()
+    except OSError:
+        st = None
+
+    if not st or time.time() - st.st_mtime >= WINERELOAD_TTL:
+        request = urllib.request.Request(WINERELOAD_URL)
+        if st:
+            request.add_header("If-Modified-Since", email.utils.formatdate(st.st_mtime, usegmt=True))
+        try:
+            with urllib.request.urlopen(request, timeout=WINERELOAD_TIMEOUT) as response:
+                data = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 304:
+                try:
+                    cache_path.touch()
+                except OSError:
+                    pass
+            elif not st:
+                raise
+            else:
+                logger.warning(f"Couldn't update winereload.py, using cached copy: {e}")
+        else:
+            try:
+                write_cache_file(cache_path, lambda f: f.write(data))
+            except OSError as e:
+                logger.info(f"Couldn't write winereload.py cache: {e}")
+                with open(dest, 'wb') as f:
+                    f.write(data)
+                return
+
+    shutil.copyfile(cache_path, dest)
+
+def find_pid(process_name):
+    with os.scandir("/proc") as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry.name}/comm") as f:
+                    if f.read().rstrip("\n") == process_name:
+                        return int(entry.name)
+            except OSError:
+                # The process went away while we were looking at it.
+                continue
+    return None
+
 def safe_cast(val, to_type, default=None):
     try:
         return to_type(val)
@@ -70,6 +259,9 @@ def main(args=None):
     parser.add_argument(
         "--verbose", "-v", action="store_true",
         help="print debug information")
+    parser.add_argument(
+        "--config-idx", type=int, default=None,
+        help="index of the launch configuration to use, skipping the prompt")
 
     parser.add_argument("appid", type=int, nargs="?", default=None)
     parser.add_argument("app_args", nargs=argparse.REMAINDER)
@@ -85,6 +277,11 @@ def main(args=None):
         parser.print_help()
         return
 
+    # protontricks is slow to import, so only pull it in once we know
+    # we'll actually be looking at Steam.
+    from protontricks.steam import (
+        find_proton_app, find_steam_path, get_steam_apps, get_steam_lib_paths)
+
     steam_path, steam_root = find_steam_path()
     steam_lib_paths = get_steam_lib_paths(steam_path)
 
@@ -97,10 +294,9 @@ def main(args=None):
         logger.error("Could not find Steam apps.")
         return
 
-    game_app = None
-    for steam_app in steam_apps:
-        if steam_app.appid == appid:
-            game_app = steam_app
+    # Search from the end to keep picking the last match, as before, should
+    # there be duplicate manifests for the app across libraries.
+    game_app = next((a for a in reversed(steam_apps) if a.appid == appid), None)
 
     if not game_app:
         logger.error(f"Cannot find game with appid: {appid}")
@@ -117,57 +313,55 @@ def main(args=None):
         return
 
     appinfo_path = steam_path / "appcache" / "appinfo.vdf"
-    appinfo = get_appinfo_sections(appinfo_path)
-    if not appinfo:
+    launch_configs = get_cached_launch_configs(appinfo_path)
+    if launch_configs is None:
         logger.error(f"Cannot find appinfo at {appinfo_path}")
         return
 
-    app_infos = get_launch_executable(appid, appinfo)
+    app_infos = get_launch_executable(appid, launch_configs)
     if not app_infos:
         logger.error(f"Cannot find launch executable from {appinfo_path}")
         return
 
     # Let the user pick an app configuration, if we only have one,
-    # just use that.
-    if len(app_infos) == 1:
-        _, working_dir, launch_executable, beta_key, app_config_args = app_infos[0]
-    else:
+    # or one was given on the command line, just use that.
+    config_idx = args.config_idx
+    if config_idx is None and len(app_infos) == 1:
+        config_idx = 0
+    elif config_idx is None:
         for x in range(0, len(app_infos)):
             description, working_dir, launch_executable, beta_key, app_config_args = app_infos[x]
-            beta_key = None
             beta_str = ""
             if beta_key:
                 beta_str = f" | Beta: {beta_key} |"
             print(f"[{x}] {description} ({launch_executable}{list_to_space_str_prefix(app_config_args, ' ')}){beta_str}")
         config_idx = safe_cast(input(f"Select a game configuration to run: "), int)
-        print(config_idx)
-        if config_idx == None or config_idx not in range(0, len(app_infos)):
-            logger.error("Invalid app configuration.")
-            return
-        _, working_dir, launch_executable, beta_key, app_config_args = app_infos[config_idx]
-            
+    if config_idx is None or not 0 <= config_idx < len(app_infos):
+        logger.error("Invalid app configuration.")
+        return
+    _, working_dir, launch_executable, beta_key, app_config_args = app_infos[config_idx]
+
+    # The launch configurations of every app and the Steam app list can
+    # be sizable and we don't need any of it from here on, so don't keep
+    # it around while waiting on the user. This only frees them as long
+    # as these locals are the last references to them.
+    del launch_configs, app_infos, steam_apps
+    gc.collect()
+
     # Dump wine-reload in /tmp so we can source
     # it from the gdb script.
-    urllib.request.urlretrieve(
-        "https://gist.githubusercontent.com/rbernon/cdbdc1b0e892f91e7449fcf3dda80bb7/raw/d8cf549bf751d99ed0fe515e36f99ff5c01b7287/WineReload.py",
-        "/tmp/winereload.py"
-    )
-
-    gdb_commands = [
-        "set confirm off",
-        "set pagination off",
-        "handle SIGUSR1 noprint nostop",
-        "handle SIGSYS noprint nostop",
-        "source /tmp/winereload.py",
-    ]
+    try:
+        fetch_winereload("/tmp/winereload.py")
+    except (OSError, http.client.HTTPException) as e:
+        logger.error(f"Couldn't download winereload.py: {e}")
+        return
 
     with open('/tmp/.protongdb_args', 'w') as f:
-        for command in gdb_commands:
-            f.write(f"{command}\n")
+        f.write(GDB_SCRIPT)
 
     executable_path = game_app.install_path / launch_executable
     working_dir = game_app.install_path / working_dir if working_dir else game_app.install_path
-    app_args = app_config_args + user_app_args
+    app_args = list(app_config_args) + user_app_args
 
     print(f"Proton: {proton_app.name} ({proton_app.appid})")
     print(f"App: {game_app.name} ({game_app.appid})")
@@ -183,23 +377,10 @@ def main(args=None):
     if len(confirm) > 0 and confirm[0] == 'N':
         return
 
-    env_vars = dict(os.environ)
-    env_vars["PATH"] = append_args(f"{proton_app.install_path}/files/bin", env_vars.get("PATH"), ":")
-    env_vars.setdefault("WINEDEBUG", "-all")
-    env_vars["WINEDLLPATH"] = prepend_args(f"{proton_app.install_path}/files/lib64/wine:{proton_app.install_path}/files/lib/wine", env_vars.get("WINEDLLPATH"), ":")
-    env_vars.setdefault("LD_LIBRARY_PATH", append_args(f"{proton_app.install_path}/files/lib64/:{proton_app.install_path}/files/lib/:{game_app.install_path}", env_vars.get("LD_LIBRARY_PATH"), ":"))
-    env_vars.setdefault("WINEPREFIX", str(game_app.prefix_path))
-    env_vars.setdefault("WINEESYNC", "1")
-    env_vars.setdefault("WINEFSYNC", "1")
-    env_vars.setdefault("SteamGameId", str(appid))
-    env_vars.setdefault("SteamAppId", str(appid))
-    env_vars["WINEDLLOVERRIDES"] = append_args("steam.exe=b;dotnetfx35.exe=b;dxvk_config=n;d3d11=n;d3d10=n;d3d10core=n;d3d10_1=n;d3d9=n;dxgi=n", env_vars.get("WINEDLLOVERRIDES"), ";")
-    env_vars.setdefault("STEAM_COMPAT_CLIENT_INSTALL_PATH", steam_path)
-    env_vars.setdefault("WINE_LARGE_ADDRESS_AWARE", "1")
-    env_vars["GST_PLUGIN_SYSTEM_PATH_1_0"] = prepend_args(f"{proton_app.install_path}/files/lib64/gstreamer-1.0:{proton_app.install_path}/files/lib/gstreamer-1.0", env_vars.get("GST_PLUGIN_SYSTEM_PATH_1_0"), ":")
-    env_vars.setdefault("WINE_GST_REGISTRY_DIR", f"{game_app.prefix_path}/gstreamer-1.0/")
+    env_vars = apply_env_spec(os.environ, get_env_spec(appid, steam_path, proton_app, game_app))
 
     subprocess.Popen([f"{proton_app.install_path}/files/bin/wine", "steam.exe", str(executable_path)] + app_args, stdin=subprocess.DEVNULL, close_fds=True, cwd=str(working_dir), env=env_vars)
+    del env_vars
 
     # Bit of a hack, to do this properly we'd need to extract the child process'
     # PID from steam.exe somehow, and this is good enough for now assuming Wine
@@ -208,19 +389,33 @@ def main(args=None):
     pid = None
     # Timeout after 3 seconds of trying to find the pid.
     timeout = time.time() + 3
-    while not pid and time.time() < timeout:
-        try:
-            pid = int(subprocess.check_output(["pidof", process_name]))
-        except subprocess.CalledProcessError:
-            pid = None
+    while True:
+        pid = find_pid(process_name)
+        if pid or time.time() >= timeout:
+            break
+        time.sleep(0.05)
 
     if not pid:
         logger.error(f"Couldn't find pid to attach for {process_name}")
         return
 
-    subprocess.call(["gdb", "-x", "/tmp/.protongdb_args", "-p", str(pid)])
-    subprocess.call(["kill", "-9", str(pid)])
-    os.remove("/tmp/.protongdb_args")
+    # Replace ourselves with gdb rather than keeping the interpreter around
+    # for the whole debug session. atexit won't run after exec, so leave a
+    # small shell behind to clean up once gdb goes away. It gets its own
+    # session so Ctrl+C in gdb doesn't take it down too.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    gdb_pid = os.getpid()
+    if os.fork() == 0:
+        try:
+            os.setsid()
+            os.execvp("sh", [
+                "sh", "-c",
+                'while kill -0 "$1" 2>/dev/null; do sleep 1; done; kill -9 "$2"; rm -f "$3"',
+                "sh", str(gdb_pid), str(pid), "/tmp/.protongdb_args"])
+        finally:
+            os._exit(1)
+    os.execvp("gdb", ["gdb", "-x", "/tmp/.protongdb_args", "-p", str(pid)])
 
 if __name__ == "__main__":
     main()